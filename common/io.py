@@ -69,6 +69,37 @@ def get_scalars(geom, attr='select', dtype=np.bool):
     return bs
 
 
+def get_buf(bufs, name, size, dtype):
+    """
+    Return a 1D array from a dict of buffers reused between calls.
+
+    Parameters
+    ----------
+    bufs : dict or None
+        Dict mapping buffer names to arrays. A missing buffer, one too
+        small, or one of another data type is replaced by a new array.
+        If None is passed, a fresh array is returned.
+    name : string
+        Name of the buffer in 'bufs'.
+    size : int
+        Number of elements of the returned array.
+    dtype : numpy.dtype
+        Numpy data type of the returned array.
+
+    Returns
+    -------
+    buf : numpy.ndarray
+        View of the first 'size' elements of the buffer.
+    """
+    if bufs is None:
+        return np.empty(size, dtype=dtype)
+    buf = bufs.get(name)
+    if buf is None or len(buf) < size or buf.dtype != dtype:
+        buf = np.empty(size, dtype=dtype)
+        bufs[name] = buf
+    return buf[:size]
+
+
 def get_bounds_and_center(points):
     """
     Calculate the bounds and center for a given set of points.
@@ -140,6 +171,58 @@ def get_parts(verts):
     return parts
 
 
+def get_face_neighbors(mesh):
+    """
+    For every face of a mesh, get the indices of the faces neighboring
+    it over each of its edges, using only vectorized property access.
+    The neighbor over an edge is the face of the next loop around that
+    edge, the same face bmesh's 'link_loop_radial_next' leads to. Faces
+    on a boundary edge are their own neighbor over it.
+
+    Parameters
+    ----------
+    mesh : bpy.types.Mesh
+        Blender mesh to get the face neighbors of.
+
+    Returns
+    -------
+    offsets : numpy.ndarray
+        Int array of length F + 1. The neighbors of face i are stored
+        in 'nbrs[offsets[i]:offsets[i + 1]]'.
+    nbrs : numpy.ndarray
+        Int array of neighbor face indices, one per face corner.
+    """
+    polys = mesh.polygons
+    ltots = get_scalars(polys, 'loop_total', np.int32)
+    lstarts = get_scalars(polys, 'loop_start', np.int32)
+    offsets = np.zeros(len(polys) + 1, dtype=np.int32)
+    np.cumsum(ltots, out=offsets[1:])
+    cnt = offsets[-1]
+
+    # Loop indices sorted by the face they belong to
+    lindcs = np.repeat(lstarts - offsets[:-1], ltots) \
+        + np.arange(cnt, dtype=np.int32)
+    eindcs = get_scalars(mesh.loops, 'edge_index', np.int32)[lindcs]
+    # Face index of every loop in that order
+    findcs = np.repeat(np.arange(len(polys), dtype=np.int32), ltots)
+
+    # Group loops sharing an edge and link every loop to the next one
+    # in its group, wrapping around at the group's end.
+    order = np.argsort(eindcs, kind='stable')
+    seindcs = eindcs[order]
+    isstart = np.ones(cnt, dtype=bool)
+    isstart[1:] = seindcs[1:] != seindcs[:-1]
+    grpstarts = np.flatnonzero(isstart)[np.cumsum(isstart) - 1]
+    nextpos = np.arange(1, cnt + 1)
+    isend = np.ones(cnt, dtype=bool)
+    isend[:-1] = isstart[1:]
+    nextpos[isend] = grpstarts[isend]
+
+    nbrs = np.empty(cnt, dtype=np.int32)
+    nbrs[order] = findcs[order[nextpos]]
+    return offsets, nbrs
+
+
 def get_lvl(ob):
     """
     Returns the number of parents of a given object, or, in other words,
@@ -0,0 +1,16 @@
+try:
+    from numba import njit
+    has_numba = True
+except ImportError:
+    # Numba isn't shipped with Blender's Python. Fall back to running
+    # the decorated functions as plain Python.
+    has_numba = False
+
+    def njit(*args, **kwargs):
+        """
+        Stand-in for numba.njit which returns the decorated function
+        unchanged. Supports both the '@njit' and '@njit(...)' forms.
+        """
+        if len(args) == 1 and callable(args[0]) and not kwargs:
+            return args[0]
+        return lambda func: func
@@ -1,20 +1,95 @@
 import bpy
 import bmesh as bm
+from math import sqrt
 import numpy as np
 
-from smorgasbord.common.io import get_scalars, get_vecs
+from smorgasbord.common.io import (
+    get_bounds_and_center,
+    get_buf,
+    get_scalars,
+    get_vecs,
+)
+from smorgasbord.common.jit import has_numba, njit
 
 
-def sample_mesh(mesh, samplecnt=1024, mask=None):
+@njit(nogil=True)
+def _bary_sample(pts, tris, areas, alpha, shift, out):
     """
-    Draw N random samples on the surface of a triangle mesh.
+    Write N samples into 'out', each drawn from the N-th point of the
+    low-discrepancy sequence given by 'alpha' and 'shift' (see
+    'quasirandom'). The point's first coordinate picks the triangle via
+    the cumulative 'areas', the other two the position on it. Computing
+    everything per sample needs no intermediate arrays at all.
+    Deliberately not parallel: callers already run it from several
+    threads, which Numba's workqueue threading layer can't handle.
+    Releases the GIL instead, so that those threads run concurrently.
+    """
+    for n in range(len(out)):
+        u0 = (shift[0] + (n + 1) * alpha[0]) % 1.
+        r1 = sqrt((shift[1] + (n + 1) * alpha[1]) % 1.)
+        r2 = (shift[2] + (n + 1) * alpha[2]) % 1.
+        t = np.searchsorted(areas, u0 * areas[-1])
+        a = tris[t, 0]
+        b = tris[t, 1]
+        c = tris[t, 2]
+        for d in range(3):
+            out[n, d] = (1 - r1) * pts[a, d] \
+                + r1 * (1 - r2) * pts[b, d] \
+                + r1 * r2 * pts[c, d]
+
+
+def _get_quasirandom_params(dim, rng):
+    """
+    Return the per-dimension step and random shift of the sequence
+    drawn by 'quasirandom'.
+    """
+    # Generalized golden ratio: the positive root of x^(dim+1) = x + 1
+    phi = 2.
+    for _ in range(32):
+        phi = (1. + phi) ** (1. / (dim + 1))
+    return phi ** -np.arange(1, dim + 1), rng.random(dim)
+
+
+def quasirandom(cnt, dim=3, rng=None):
+    """
+    Draw a randomly shifted low-discrepancy sequence of points in the
+    unit hypercube. It is generated by the additive recurrence based on
+    the generalized golden ratio, which covers the cube more evenly
+    than independent random points, so fewer of them are needed for
+    the same accuracy.
+
+    Parameters
+    ----------
+    cnt : int
+        Number of points to draw.
+    dim : int = 3
+        Dimension of each point.
+    rng : numpy.random.Generator or None = None
+        Random number generator to draw the shift of the sequence from.
+        If None is passed, a fresh one is created.
+
+    Returns
+    -------
+    out : numpy.ndarray
+        2D float32 array with shape (cnt, dim) of values in [0, 1).
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+    alpha, shift = _get_quasirandom_params(dim, rng)
+    out = np.arange(1, cnt + 1)[:, None] * alpha + shift
+    return np.mod(out, 1.).astype(np.float32)
+
+
+def get_sampling_data(mesh, mask=None):
+    """
+    Read everything from a mesh needed to sample its surface. Only this
+    step accesses Blender data, so it must run on the main thread, while
+    'sample_surf' can run on any.
 
     Parameters
     ----------
     mesh : bpy.types.Mesh
         Blender mesh to sample from.
-    samplecnt : int = 1024
-        Number of samples to use.
     mask : Iterable or None = None
         Iterable specifying the faces from which to sample either by
         passing their index in the mesh's face list as an Integer
@@ -23,9 +98,13 @@ def sample_mesh(mesh, samplecnt=1024, mask=None):
 
     Returns
     -------
-    out : numpy.ndarray
-        2D array with shape (N, 3), containing the coordinates of the
-        N drawn sample points.
+    areas : numpy.ndarray
+        Cumulative sum of the areas of the mesh's triangles.
+    pts : numpy.ndarray
+        2D array with shape (V, 3) of vertex coordinates.
+    tris : numpy.ndarray
+        2D array with shape (T, 3) of the vertex indices of each
+        triangle.
     """
     # Load mesh into bmesh,
     bob = bm.new()
@@ -47,65 +126,197 @@ def sample_mesh(mesh, samplecnt=1024, mask=None):
 
     # Accumulate all triangle areas in the mesh to sample each triangle
     # with a probability proportional to its surface area.
-    areas = get_scalars(mesh.polygons, 'area', np.float64)
+    # Single precision suffices for sampling and halves the memory
+    # traffic of everything downstream.
+    areas = get_scalars(mesh.polygons, 'area', np.float32)
     areas = np.cumsum(areas)
-    # Choose N random floats between 0 and the sum of all areas.
-    rdareas = np.random.uniform(0., areas[-1], samplecnt)
+    # Get the vertex coordinates.
+    pts = get_vecs(mesh.vertices, dtype=np.float32)
+    # Get the vertex indices for each triangle.
+    tris = get_vecs(mesh.polygons, 'vertices', dtype=np.int32)
+    bpy.data.meshes.remove(mesh)
+    return areas, pts, tris
+
+
+def sample_surf(data, samplecnt=1024, rng=None, bufs=None):
+    """
+    Draw N random samples on the surface of a triangle mesh.
+
+    Parameters
+    ----------
+    data : tuple
+        Sampling data of a mesh, as returned by 'get_sampling_data'.
+    samplecnt : int = 1024
+        Number of samples to use.
+    rng : numpy.random.Generator or None = None
+        Random number generator to shift the low-discrepancy sequence
+        the samples are drawn from. If None is passed, a fresh one is
+        created.
+    bufs : dict or None = None
+        Dict of intermediate arrays to reuse between calls. Missing or
+        too small arrays are allocated and stored in it. Must not be
+        used by two threads at once. If None is passed, every array is
+        allocated anew. Unused if Numba is available, as no
+        intermediate arrays are needed then.
+
+    Returns
+    -------
+    out : numpy.ndarray
+        2D array with shape (N, 3), containing the coordinates of the
+        N drawn sample points.
+    """
+    areas, pts, tris = data
+    if rng is None:
+        rng = np.random.default_rng()
+
+    if has_numba:
+        out = np.empty((samplecnt, 3), dtype=pts.dtype)
+        _bary_sample(
+            pts, tris, areas, *_get_quasirandom_params(3, rng), out)
+        return out
+
+    # Three low-discrepancy floats per sample: the first picks the
+    # triangle, the other two the position on it.
+    rdvals = quasirandom(samplecnt, 3, rng)
+    # Choose N floats between 0 and the sum of all areas.
+    rdareas = get_buf(bufs, 'rdareas', samplecnt, np.float32)
+    np.multiply(rdvals[:, 0], areas[-1], out=rdareas)
     # For each random float, find the index of the triangle with the
     # highest, but less equal cumulative area (the left neighbor of the
     # randomly drawn area).
     rdindcs = np.searchsorted(areas, rdareas)
-    # These vectorized calculations eat up a lot of memory. Make some
-    # unneeded data applicable for garbage collection.
-    del areas, rdareas
+    del rdareas
 
-    # Get the vertex coordinates.
-    pts = get_vecs(mesh.vertices)
-    # Get the vertex indices for each triangle.
-    tris = get_vecs(mesh.polygons, 'vertices', dtype=np.int32)
-    bpy.data.meshes.remove(mesh)
-    # Inner indexing operation: For each randomly chosen triangle index,
-    # insert the actual vertex indices of the corresponding triangle
-    # into the array.
-    # Outer indexing operation: For each vertex index in the triangle
-    # array, insert its actual vertex coordinates.
-    # This 3D array holds a lot of redundant data now, this probably
-    # scales pretty badly with the sample count and the number of
-    # triangles.
-    tris = pts[tris[rdindcs, :]]
-    del rdindcs, pts
-
-    # For each sample, draw two random floats that determine where on
-    # the triangle the sample point is placed.
+    # For each sample, two floats determine where on the triangle the
+    # sample point is placed.
     # This is done via the following formula, with the triangle's
     # vertex coordinate vectors A, B, C:
     # P = (1 - sqrt(r1))*A + sqrt(r1)*(1 - r2)*B + sqrt(r1)*r2*C
-    r1 = np.sqrt(np.random.rand(samplecnt))
-    r2 = np.random.rand(samplecnt)
-    # Calculate coefficients for each vertex A, B, C
-    coef = np.stack(
-        (1 - r1, r1 * (1 - r2), r1 * r2),
-        axis=1,
-        ).reshape(-1, 3, 1)
+    r1 = rdvals[:, 1]
+    r2 = rdvals[:, 2]
+    del rdvals
+
+    # For each randomly chosen triangle index, get the actual vertex
+    # indices of the corresponding triangle.
+    vindcs = get_buf(bufs, 'vindcs', samplecnt * 3, tris.dtype)
+    vindcs.shape = (-1, 3)
+    # Indices are valid by construction. Any mode but 'raise' lets
+    # np.take write into 'out' directly instead of buffering it.
+    np.take(tris, rdindcs, axis=0, out=vindcs, mode='clip')
+    del rdindcs
+
+    # Calculate coefficients for each vertex A, B, C in place, without
+    # the temporaries of stacking the three expressions.
+    coef = get_buf(bufs, 'coef', samplecnt * 3, r1.dtype)
+    coef.shape = (3, -1)
+    np.sqrt(r1, out=r1)
+    np.subtract(1, r1, out=coef[0])
+    np.multiply(r1, r2, out=coef[2])
+    # sqrt(r1)*(1 - r2) = sqrt(r1) - sqrt(r1)*r2
+    np.subtract(r1, coef[2], out=coef[1])
     del r1, r2
-    # For each triangle sum up A, B, and C, leaving one point per
-    # sample. Remember, one triangle can be several times in 'tris',
-    # but a different sample is drawn from its surface every time.
-    return np.sum(coef * tris, axis=1)
+
+    # Sum up A, B, and C one corner at a time, leaving one point per
+    # sample. Remember, one triangle can be chosen several times, but a
+    # different sample is drawn from its surface every time.
+    out = np.empty((samplecnt, 3), dtype=pts.dtype)
+    tmp = get_buf(bufs, 'tmp', samplecnt * 3, pts.dtype)
+    tmp.shape = (-1, 3)
+    np.take(pts, vindcs[:, 0], axis=0, out=out, mode='clip')
+    out *= coef[0, :, None]
+    for i in (1, 2):
+        np.take(pts, vindcs[:, i], axis=0, out=tmp, mode='clip')
+        tmp *= coef[i, :, None]
+        out += tmp
+    return out
 
 
-def get_shape_distrib(points, bincnt=32):
+def sample_mesh(mesh, samplecnt=1024, mask=None):
+    """
+    Draw N random samples on the surface of a triangle mesh.
+
+    Parameters
+    ----------
+    mesh : bpy.types.Mesh
+        Blender mesh to sample from.
+    samplecnt : int = 1024
+        Number of samples to use.
+    mask : Iterable or None = None
+        Iterable specifying the faces from which to sample either by
+        passing their index in the mesh's face list as an Integer
+        iterable or as a Bool iterable where that specific index is set
+        to True. If None is passed, every face is sampled.
+
+    Returns
+    -------
+    out : numpy.ndarray
+        2D array with shape (N, 3), containing the coordinates of the
+        N drawn sample points.
+    """
+    return sample_surf(get_sampling_data(mesh, mask), samplecnt)
+
+
+def get_shape_distrib(points, bins=32, retbins=False, chunksize=1 << 18):
     """
     Calculate a shape distribution from a set of points.
+    The distances between every pair of points are streamed through
+    the histogram block by block, so that at most about 'chunksize'
+    of them are held in memory at once instead of N * (N - 1) / 2.
     :param points: List-like object of points to calculate the
         distribution for.
-    :param bincnt: Resolution of the distribution: the bin count
-        of the histogram representing the distribution.
+    :param bins: Resolution of the distribution: either the bin count
+        of the histogram representing the distribution, or its bin
+        edges. Pass the same edges for distributions to be compared.
+        A bin count is spread evenly up to the points' bounding box
+        diagonal.
+    :param retbins: Whether to also return the bin edges.
+    :param chunksize: Maximum number of distances computed at once.
+    :return: The histogram's counts, and its bin edges if 'retbins' is
+        True.
     """
     points = np.asanyarray(points)
-    # k=1 eliminates diagonal indices
-    i, j = np.triu_indices(len(points), k=1)
-    return np.histogram(
-        np.linalg.norm(points[i] - points[j], axis=1),
-        bins=bincnt,
-        )
+    if np.ndim(bins) == 0:
+        bounds, _ = get_bounds_and_center(points)
+        bins = np.linspace(0., np.linalg.norm(bounds), bins + 1)
+
+    # Distances don't change when moving every point, but centering
+    # them keeps their norms small, which limits the cancellation error
+    # in the squared distances below.
+    points = points - points.mean(axis=0)
+    # Squared norm of every point
+    sqnorms = np.einsum('ij,ij->i', points, points)
+
+    cnt = len(points)
+    hist = np.zeros(len(bins) - 1, dtype=np.int64)
+    # Number of rows of the distance matrix handled per block
+    rowcnt = max(1, chunksize // max(cnt, 1))
+    # Reused for the distances of every block
+    buf = np.empty(rowcnt * cnt, dtype=points.dtype)
+    # Rounding can push the longest distances just past the last edge,
+    # where np.histogram would silently drop them, so clamp them to it.
+    # Converted to the distances' data type the edge itself may round
+    # up, so use the next smaller value in that case.
+    top = buf.dtype.type(bins[-1])
+    if top > bins[-1]:
+        top = np.nextafter(top, buf.dtype.type(0))
+
+    for s in range(0, cnt - 1, rowcnt):
+        e = min(s + rowcnt, cnt - 1)
+        dists = buf[:(e - s) * (cnt - s)].reshape(e - s, cnt - s)
+        # Squared distances |a - b|^2 = |a|^2 + |b|^2 - 2ab, so the bulk
+        # of the work is a single matrix product
+        np.matmul(points[s:e], points[s:].T, out=dists)
+        dists *= -2
+        dists += sqnorms[s:e, None]
+        dists += sqnorms[s:]
+        # Rounding can make squared distances of near points negative
+        np.maximum(dists, 0, out=dists)
+        np.sqrt(dists, out=dists)
+        np.minimum(dists, top, out=dists)
+        # Only keep entries right of the diagonal, so that every pair
+        # is counted once
+        hist += np.histogram(
+            dists[np.arange(cnt - s) > np.arange(e - s)[:, None]],
+            bins=bins,
+            )[0]
+    return (hist, bins) if retbins else hist
@@ -1,28 +1,165 @@
 import bmesh as bm
 import bpy
-from math import pi
+from math import pi, sqrt
 import numpy as np
 
-from smorgasbord.common.io import (
-    get_bounds_and_center,
-    get_scalars,
-    get_vecs,
-)
-from smorgasbord.common.transf import normalize
+from smorgasbord.common.io import get_buf, get_face_neighbors
 from smorgasbord.common.decorate import register
+from smorgasbord.common.jit import njit
 
 
 pihalf = pi * 0.5
 
 
-def _select(x):
-    x.select = True
-_selall = np.vectorize(_select)
+@njit(nogil=True)
+def _flood(
+        nbr_offsets,
+        nbr_indcs,
+        centrs,
+        normals,
+        flags,
+        start,
+        stack,
+        out,
+        ):
+    """
+    Starting at face 'start', visit every face connected to it over
+    edges between faces not facing away from each other.
 
+    Parameters
+    ----------
+    nbr_offsets : numpy.ndarray
+        Int array of length F + 1. The neighbors of face i are stored
+        in 'nbr_indcs[nbr_offsets[i]:nbr_offsets[i + 1]]'.
+    nbr_indcs : numpy.ndarray
+        Int array of neighboring face indices.
+    centrs : numpy.ndarray
+        Face centers with shape (F, 3).
+    normals : numpy.ndarray
+        Face normals with shape (F, 3).
+    flags : numpy.ndarray
+        Bool array of faces not yet visited. Visited faces are set to
+        False.
+    start : int
+        Index of the face to start from. Its flag must already be False.
+    stack : numpy.ndarray
+        Int array of length F used as stack of faces to visit. Its
+        content is overwritten.
+    out : numpy.ndarray
+        Int array to write the visited face indices into. Must be long
+        enough to hold every face still flagged.
 
-def _deselect(x):
-    x.select = False
-_deselall = np.vectorize(_deselect)
+    Returns
+    -------
+    cnt : int
+        Number of visited faces written into 'out'.
+    maxdot : float
+        Maximum dot product between two neighboring faces in the patch.
+    """
+    # Every face is pushed at most once, so the stack can't overflow
+    stack[0] = start
+    sp = 1
+    cnt = 0
+    maxdot = 0.
+
+    while sp > 0:
+        sp -= 1
+        f = stack[sp]
+        out[cnt] = f
+        cnt += 1
+        n = normals[f]
+        c = centrs[f]
+
+        # Push all faces connected to f on stack...
+        for k in range(nbr_offsets[f], nbr_offsets[f + 1]):
+            f2 = nbr_indcs[k]
+            # but only if not already checked
+            if not flags[f2]:
+                continue
+            dx = centrs[f2, 0] - c[0]
+            dy = centrs[f2, 1] - c[1]
+            dz = centrs[f2, 2] - c[2]
+            # The dot product between f's normal and the normalized
+            # vector between both face's centers is a simple way to
+            # measure if they are parallel (=0), concave (>0), or
+            # convex (<0).
+            angl = n[0] * dx + n[1] * dy + n[2] * dz
+            l = sqrt(dx * dx + dy * dy + dz * dz)
+            if l != 0:
+                angl /= l
+            # and f and f2 are not convex (don't face away from each
+            # other)
+            if angl > -1e-3:
+                maxdot = max(maxdot, angl)
+                flags[f2] = False
+                stack[sp] = f2
+                sp += 1
+    return cnt, maxdot
+
+
+@njit(nogil=True)
+def _find_patches(
+        nbr_offsets,
+        nbr_indcs,
+        centrs,
+        normals,
+        flags,
+        seeds,
+        stack,
+        out,
+        offsets,
+        maxdots,
+        ):
+    """
+    Flood fill patches from every seed face not yet visited and store
+    those with more than two faces back to back. See '_flood' for the
+    parameters not listed here.
+
+    Parameters
+    ----------
+    seeds : numpy.ndarray
+        Int array of face indices to start flood fills from.
+    out : numpy.ndarray
+        Int array of length F to write the face indices of all stored
+        patches into.
+    offsets : numpy.ndarray
+        Int array to write the start of every stored patch in 'out'
+        into, followed by the end of the last one.
+    maxdots : numpy.ndarray
+        Float array to write the maximum dot product between two
+        neighboring faces of every stored patch into.
+
+    Returns
+    -------
+    npatches : int
+        Number of stored patches.
+    """
+    npatches = 0
+    # End of the last stored patch in 'out'
+    end = 0
+    for i in seeds:
+        # Skip faces visited by an earlier flood fill
+        if not flags[i]:
+            continue
+        flags[i] = False
+        cnt, maxdot = _flood(
+            nbr_offsets,
+            nbr_indcs,
+            centrs,
+            normals,
+            flags,
+            i,
+            stack,
+            out[end:],
+            )
+        # Patches too small are overwritten by the next one
+        if cnt > 2:
+            offsets[npatches] = end
+            maxdots[npatches] = maxdot
+            npatches += 1
+            end += cnt
+    offsets[npatches] = end
+    return npatches
 
 
 @register
@@ -68,6 +205,9 @@ class SelectConcaveParts(bpy.types.Operator):
         max=pihalf,
     )
     _meshes = []
+    # Arrays reused for every processed object, so that they are only
+    # allocated again if an object has more faces than any before.
+    _bufs = {}
 
     @classmethod
     def poll(cls, context):
@@ -90,71 +230,67 @@ class SelectConcaveParts(bpy.types.Operator):
             o.update_from_editmode()
             data = o.data
             polys = data.polygons
-            bob = bm.from_edit_mesh(data)
-            bfaces = bob.faces
-            bfaces.ensure_lookup_table()
-            # bmesh has to recalculate face centers, so get them
-            # directly from the mesh data instead
-            centrs = get_vecs(polys, attr='center')
-            # Bool array of vertex indices already visited.
-            # Unselected faces will be True already.
-            flags = get_scalars(polys)
-            # Will contain a list of tuples. First entry is the list of
-            # face indices of the patch. Second is the maximum angle
-            # between two neighboring faces in the patch.
-            # This list is only needed to not delete vertices while we
-            # iterate the mesh.
-            patches = []
-
-            for i, new in enumerate(flags):
-                if not new:
-                    continue
-
-                flags[i] = False
-                # Faces to visit
-                stack = [bfaces[i]]
-                # Face indices of the patch
-                findcs = []
-                # Maximum dot product between two neighboring faces in
-                # the patch.
-                maxdot = 0
-
-                while stack:
-                    f = stack.pop()
-                    n = f.normal
-                    c = centrs[f.index]
-                    findcs.append(f.index)
-
-                    # Push all faces connected to f on stack...
-                    for l in f.loops:
-                        f2 = l.link_loop_radial_next.face
-                        i2 = f2.index
-                        # The dot product between f's normal and the
-                        # vector between both face's centers is a
-                        # simple way to measure if they are parallel
-                        # (=0), concave (>0), or convex (<0).
-                        angl = n.dot(normalize(centrs[i2] - c))
-                        # but only if not already checked and f and f2
-                        # are not convex (don't face away from each 
-                        # other)
-                        if flags[i2] and angl > -1e-3:
-                            maxdot = max(maxdot, angl)
-                            flags[i2] = False
-                            stack.append(f2)
-
-                if len(findcs) > 2:
-                    # pihalf: transform dot product result to rad angle
-                    patches.append((findcs, maxdot * pihalf))
-
+            nfaces = len(polys)
+            # Neighbor face indices of every face in CSR form, so that
+            # the flood fill only touches NumPy arrays.
+            nbr_offsets, nbr_indcs = get_face_neighbors(data)
+            # Get face centers and normals directly from the mesh data,
+            # bmesh would have to recalculate them
+            centrs = get_buf(self._bufs, 'centrs', nfaces * 3, np.float32)
+            polys.foreach_get('center', centrs)
+            centrs.shape = (-1, 3)
+            normals = get_buf(self._bufs, 'normals', nfaces * 3, np.float32)
+            polys.foreach_get('normal', normals)
+            normals.shape = (-1, 3)
+            # Bool array of faces not visited yet. Only selected faces
+            # are searched for patches, so unselected faces start out
+            # as already visited (False).
+            flags = get_buf(self._bufs, 'flags', nfaces, np.bool_)
+            polys.foreach_get('select', flags)
+            # Stack of faces to visit during a flood fill, shared by all
+            stack = get_buf(self._bufs, 'stack', nfaces, np.int32)
+            # Face indices of all patches, stored back to back. Patches
+            # are disjoint, so they fit into one array of face count
+            # length.
+            findcs_all = np.empty(nfaces, dtype=np.int32)
+            # Every stored patch has at least three faces
+            offsets = np.empty(nfaces // 3 + 1, dtype=np.int32)
+            maxdots = np.empty(nfaces // 3, dtype=np.float64)
+            # Only start at selected faces
+            npatches = _find_patches(
+                nbr_offsets,
+                nbr_indcs,
+                centrs,
+                normals,
+                flags,
+                np.flatnonzero(flags),
+                stack,
+                findcs_all,
+                offsets,
+                maxdots,
+                )
             del flags
-            # second representation of patches, this time as a tuple of
-            # face indices, max angle, and diameter
-            patches2 = []
+            starts = offsets[:npatches]
+            ends = offsets[1:npatches + 1]
 
-            for findcs, maxangl in patches:
-                bounds, _ = get_bounds_and_center(centrs[findcs])
-                patches2.append((findcs, maxangl, np.linalg.norm(bounds)))
-            self._meshes.append((data, patches2))
+            # Diameter of every patch's bounding box, computed for all
+            # patches at once over their back to back face centers.
+            diams = ()
+            if npatches:
+                pcentrs = centrs[findcs_all[:ends[-1]]]
+                bounds = np.maximum.reduceat(pcentrs, starts) \
+                    - np.minimum.reduceat(pcentrs, starts)
+                diams = np.linalg.norm(bounds, axis=1)
+                del pcentrs, bounds
+
+            # List of tuples of face indices, max angle, and diameter of
+            # each patch. Face indices are views into 'findcs_all', not
+            # copies. pihalf: transform dot product result to rad angle
+            patches = [
+                (findcs_all[s:e], maxdot * pihalf, diam)
+                for s, e, maxdot, diam in zip(starts, ends, maxdots, diams)
+                ]
+            self._meshes.append((data, patches))
 
     def execute(self, context):
         mind, maxd = self._limits
@@ -162,13 +298,19 @@ class SelectConcaveParts(bpy.types.Operator):
         # Iterate over results computed during invoke()
         for mesh, patches in self._meshes:
             bob = bm.from_edit_mesh(mesh)
-            bfaces = np.array(bob.faces)
-            _deselall(bfaces)
-            for findcs, maxangl, diam in patches:
-                # Only select patches whose diameter lies within limits
-                # and biggest angle between two neighboring faces is
-                # big enough
-                if mind < diam <= maxd and maxangl > self.minangl:
-                    _selall(bfaces[findcs])
+            bfaces = bob.faces
+            for f in bfaces:
+                f.select = False
+            # Only select patches whose diameter lies within limits
+            # and biggest angle between two neighboring faces is big
+            # enough. Gather them all to select them in one go.
+            sel = [findcs for findcs, maxangl, diam in patches
+                   if mind < diam <= maxd and maxangl > self.minangl]
+            if sel:
+                # Index the face sequence directly instead of converting
+                # all of it into an array
+                bfaces.ensure_lookup_table()
+                for i in np.concatenate(sel).tolist():
+                    bfaces[i].select = True
             bm.update_edit_mesh(mesh)
         return {'FINISHED'}
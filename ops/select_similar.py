@@ -1,13 +1,58 @@
 import bpy
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from math import ceil, sqrt
 import numpy as np
+import os
+from queue import Empty, SimpleQueue
 
-from smorgasbord.common.io import get_bounds_and_center
+from smorgasbord.common.io import (
+    get_bounds_and_center,
+    get_scalars,
+    get_vecs,
+)
 from smorgasbord.common.transf import transf_vecs
 from smorgasbord.common.decorate import register
 from smorgasbord.common.draw import draw_points, View3DDrawer
-from smorgasbord.common.sample import sample_mesh, get_shape_distrib
-# from smorgasbord.debug.plot import save_barplot
+from smorgasbord.common.sample import (
+    get_sampling_data,
+    get_shape_distrib,
+    sample_surf,
+)
+
+
+def _sample(data, seed, samplecnt, bufpool):
+    """
+    Sample a mesh's surface in local space. Doesn't access Blender
+    data, so it can run on any thread. Intermediate arrays are taken
+    from a dict of buffers in 'bufpool', which is held exclusively for
+    the duration of the call.
+    """
+    try:
+        bufs = bufpool.get_nowait()
+    except Empty:
+        bufs = {}
+    try:
+        return sample_surf(
+            data, samplecnt, np.random.default_rng(seed), bufs)
+    finally:
+        bufpool.put(bufs)
+
+
+def _to_world(points, mat):
+    """
+    Return an object's local space samples in world space, together
+    with the diagonal of their bounding box, which limits every
+    distance between them. Doesn't access Blender data, so it can run
+    on any thread.
+    """
+    points = transf_vecs(mat, points)
+    bounds, _ = get_bounds_and_center(points)
+    return points, np.linalg.norm(bounds)
+
+
+# Histogram bin counts of power-of-two sample counts, the common case
+_bincnts = {1 << i: ceil(sqrt(1 << i)) for i in range(1, 15)}
 
 
 @register
@@ -29,8 +74,13 @@ class SelectSimilar(bpy.types.Operator):
         return SelectSimilar._samplcnt
 
     def _set_samplecnt(self, val):
+        if val != SelectSimilar._samplcnt:
+            SelectSimilar._sampl_cache.clear()
         SelectSimilar._samplcnt = val
-        SelectSimilar.bincnt = ceil(sqrt(val))
+        bincnt = _bincnts.get(val)
+        if bincnt is None:
+            bincnt = ceil(sqrt(val))
+        SelectSimilar.bincnt = bincnt
 
     def _update_sim_limits(self, context):
         SelectSimilar._resampl = False
@@ -38,7 +88,9 @@ class SelectSimilar(bpy.types.Operator):
     def _update_samplecnt(self, context):
         SelectSimilar._resampl = True
 
-    _sel_limits = (0, 1)
+    # The difference between two shapes lies in [0, 2], independent of
+    # the sample count
+    _sel_limits = (0, 0.04)
     sel_limits: bpy.props.FloatVectorProperty(
         name="Similarity limits",
         description=(
@@ -46,14 +98,14 @@ class SelectSimilar(bpy.types.Operator):
             "than max from the active objects' shape"
         ),
         size=2,
-        step=10,
+        step=1,
         default=_sel_limits,
         min=0,
         get=_get_sel_limits,
         set=_set_sel_limits,
         update=_update_sim_limits,
     )
-    _samplcnt = 512
+    _samplcnt = 256
     samplcnt: bpy.props.IntProperty(
         name="Sample count",
         description=(
@@ -89,6 +141,20 @@ class SelectSimilar(bpy.types.Operator):
     _resampl = True
     # Stores bgl handles for drawing the sample positions
     _gl_handls = []
+    # Seed of the random number generator of the first sampled mesh.
+    # Every following mesh i uses seed + i.
+    _seed = 0
+    # Local space samples of every mesh sampled so far, so that they
+    # don't need to be drawn again on the next execution. Key is the
+    # mesh's address, vertex and face count, value a tuple of a hash of
+    # its vertex coordinates and face corners, to detect edits, and the
+    # samples. Only meshes compared in the last execution are kept.
+    _sampl_cache = {}
+    # Dicts of intermediate arrays reused when sampling, one per thread
+    # sampling at the same time
+    _sampl_bufs = SimpleQueue()
+    # Save a plot of every compared object's shape distribution to disk
+    _debug = False
 
     def __del__(self):
         self._gl_handls.clear()
@@ -108,12 +174,15 @@ class SelectSimilar(bpy.types.Operator):
         :param xvals: Values on the plot's x-axis
         :param yvals: Values on the plot's y-axis
         """
+        # Only needed for debugging, so don't load matplotlib otherwise
+        from smorgasbord.debug.plot import save_barplot
+
         bounds, _ = get_bounds_and_center(ob.bound_box)
         maxdist = np.linalg.norm(bounds)
         save_barplot(
             xvals=xvals[:-1],
             yvals=yvals,
-            barwidth=maxdist / self.bincnt,
+            barwidth=xvals[1] - xvals[0],
             # xmax=maxdist,
             title=(
                 f"Samples: {self._samplcnt}, "
@@ -123,28 +192,16 @@ class SelectSimilar(bpy.types.Operator):
             filename=ob.name,
             )
 
-    def _get_shape_distrib(self, ob):
+    def _draw_samples(self, points):
         """
-        Sample an object's surface, draw the samples in the 3D view,
-        return the object's shape distribution, and optionally save it
-        as a plot to disk.
+        Draw sample points in the 3D view.
         """
-        points = sample_mesh(ob.data, self._samplcnt)
-
-        # Draw samples
-        points = transf_vecs(ob.matrix_world, points)
-        if self.draw_sampls:
-            drawer = View3DDrawer(draw_points)
-            self._gl_handls.append(drawer)
-            try:
-                drawer(tuple(points))
-            except RuntimeError as e:
-                self.report({'WARNING'}, str(e))
-
-        # Calc and plot shape distribution
-        hist, bins = get_shape_distrib(points, self.bincnt)
-        # self._save_barplot(ob, bins, hist)
-        return hist
+        drawer = View3DDrawer(draw_points)
+        self._gl_handls.append(drawer)
+        try:
+            drawer(tuple(points))
+        except RuntimeError as e:
+            self.report({'WARNING'}, str(e))
 
     def _comp_shape_distribs(self, context):
         """
@@ -155,11 +212,7 @@ class SelectSimilar(bpy.types.Operator):
         self.svals.clear()
         # Don't show the sampled points anymore
         self._gl_handls.clear()
-        # For handling errors if no object has mesh data
-        all_type_err = True
         ob = context.object
-        # Get shape distribution of active object
-        adis = self._get_shape_distrib(ob)
 
         # Compare active with the rest of the selection if a selection
         # exists, compare all objects in the active collection if not.
@@ -168,23 +221,92 @@ class SelectSimilar(bpy.types.Operator):
         # Blender, but is not counted in here
         if len(selobs) < 2:
             selobs = context.collection.objects
-        for o in selobs:
-            if o.type != 'MESH' or o is ob:
-                continue
-            all_type_err = False
-            odis = self._get_shape_distrib(o)
+        # Active object first, followed by every one to compare with
+        obs = [ob]
+        obs.extend(o for o in selobs if o.type == 'MESH' and o is not ob)
+
+        if len(obs) < 2:
+            self.report({'ERROR_INVALID_INPUT'},
+                        "Only mesh objects can be compared")
+            return False
+
+        # Blender data must only be accessed from the main thread, so
+        # read everything needed up front. Sampling and computing the
+        # distributions then runs in parallel, as NumPy releases the
+        # GIL for most of it.
+        mats = [np.array(o.matrix_world, dtype=np.float32) for o in obs]
+        keys = [(
+            o.data.as_pointer(),
+            len(o.data.vertices),
+            len(o.data.polygons),
+            ) for o in obs]
+        # Evict meshes not compared this time, e.g. deleted ones
+        for key in self._sampl_cache.keys() - set(keys):
+            del self._sampl_cache[key]
+        # Sampling data of every mesh not found in the cache. Objects
+        # sharing a mesh are only sampled once.
+        todo = {}
+        for key, o in dict(zip(keys, obs)).items():
+            mesh = o.data
+            # Changes to vertex positions or to which vertices make up
+            # the faces invalidate the cached samples
+            tag = hash((
+                get_vecs(mesh.vertices, dtype=np.float32).tobytes(),
+                get_scalars(mesh.loops, 'vertex_index', np.int32).tobytes(),
+                ))
+            cached = self._sampl_cache.get(key)
+            if cached is None or cached[0] != tag:
+                todo[key] = (tag, get_sampling_data(mesh))
+
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as ex:
+            sampls = ex.map(
+                partial(
+                    _sample,
+                    samplecnt=self._samplcnt,
+                    bufpool=self._sampl_bufs,
+                    ),
+                [data for _, data in todo.values()],
+                range(self._seed, self._seed + len(todo)),
+                )
+            for (key, (tag, _)), points in zip(todo.items(), sampls):
+                self._sampl_cache[key] = (tag, points)
+            worlds = list(ex.map(
+                _to_world,
+                [self._sampl_cache[k][1] for k in keys],
+                mats,
+                ))
+
+            # Every histogram must share the same bin edges, otherwise
+            # comparing them bin by bin is meaningless. Derive them
+            # from the samples themselves rather than the objects'
+            # bounding boxes, which include modifiers the samples don't.
+            maxdiag = max(diag for _, diag in worlds)
+            bins = np.linspace(0., maxdiag, self.bincnt + 1)
+            hists = list(ex.map(
+                partial(get_shape_distrib, bins=bins),
+                [points for points, _ in worlds],
+                ))
+
+        if self.draw_sampls:
+            for points, _ in worlds:
+                self._draw_samples(points)
+        if self._debug:
+            for o, hist in zip(obs, hists):
+                self._save_barplot(o, bins, hist)
+
+        # Get shape distribution of active object
+        adis = hists[0]
+        # Number of sample pairs counted in every histogram. Dividing by
+        # it makes similarity values independent of the sample count.
+        paircnt = self._samplcnt * (self._samplcnt - 1) / 2.
+        for o, odis in zip(obs[1:], hists[1:]):
             # Calculate similarity value to active object and store it.
             # Sadly we can't store a reference to 'o' directly, because
             # those references become invalid on undo, which is
             # triggered every time this operator is re-executed with
             # different parameters
             self.svals[o.name] = np.linalg.norm(odis - adis, ord=1) \
-                / (self._samplcnt * 10.)
-
-        if all_type_err:
-            self.report({'ERROR_INVALID_INPUT'},
-                        "Only mesh objects can be compared")
-            return False
+                / paircnt
         return True
 
     def cancel(self, context):